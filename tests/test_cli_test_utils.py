@@ -0,0 +1,71 @@
+#
+# Copyright (c) nexB Inc. and others. All rights reserved.
+# purldb is a trademark of nexB Inc.
+# SPDX-License-Identifier: Apache-2.0
+# See http://www.apache.org/licenses/LICENSE-2.0 for the license text.
+# See https://github.com/aboutcode-org/purldb for support or download.
+# See https://aboutcode.org for more information about nexB OSS projects.
+#
+
+import copy
+import json
+
+import pytest
+
+from purldb_toolkit import cli_test_utils
+
+
+class TestRemoveUuidStream:
+    def test_remove_uuid_stream_matches_remove_uuid_from_scan(self, tmp_path):
+        """
+        Test that the streaming UUID rewrite produces the same scan data as
+        the in-memory `remove_uuid_from_scan`.
+        """
+        pytest.importorskip("ijson")
+
+        scan = {
+            "headers": [{"tool_version": "1.0", "options": {"--json": True}, "errors": []}],
+            "packages": [
+                {
+                    "package_uid": "pkg:pypi/foo@1.0?uuid=aaa-111",
+                    "size": 12,
+                    "homepage_url": None,
+                    "is_virtual": True,
+                    "score": 1.5,
+                }
+            ],
+            "dependencies": [
+                {
+                    "dependency_uid": "pkg:pypi/bar@2.0?uuid=bbb-222",
+                    "for_package_uid": "pkg:pypi/foo@1.0?uuid=aaa-111",
+                }
+            ],
+            "files": [
+                {
+                    "path": 'a/b "quoted" é',
+                    "for_packages": ["pkg:pypi/foo@1.0?uuid=aaa-111"],
+                    "scan_errors": [],
+                },
+                {
+                    "path": "c",
+                    "for_packages": [],
+                    "extra_data": {"nested": [1, 2, {"x": "y"}]},
+                },
+                {
+                    # uid-named keys outside the packages, dependencies and
+                    # for_packages sections must not be rewritten
+                    "path": "d",
+                    "package_uid": "pkg:pypi/baz@3.0?uuid=ccc-333",
+                    "extra_data": {"for_package_uid": "pkg:pypi/baz@3.0?uuid=ccc-333"},
+                },
+            ],
+        }
+        input_file = tmp_path / "scan.json"
+        output_file = tmp_path / "scan-no-uuid.json"
+        input_file.write_text(json.dumps(scan))
+
+        cli_test_utils.remove_uuid_stream(str(input_file), str(output_file))
+
+        streamed = json.loads(output_file.read_text())
+        expected = cli_test_utils.remove_uuid_from_scan(copy.deepcopy(scan))
+        assert streamed == expected